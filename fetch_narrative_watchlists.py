@@ -1,55 +1,173 @@
 import os
 import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
 import time
-from collections import deque, OrderedDict
+import functools
+import hashlib
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 import logging
-from urllib.parse import urlparse, parse_qsl, urlunparse
+from urllib.parse import urlparse, parse_qsl, urlunparse, urlencode
 import argparse
 import re
 
+# Prefer a faster JSON parser when one is installed
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+        _json_loads = ujson.loads
+    except ImportError:
+        _json_loads = json.loads
+
+# urllib3 can only decode Brotli responses when the brotli package is installed
+try:
+    import brotli  # noqa: F401
+    _HAS_BROTLI = True
+except ImportError:
+    _HAS_BROTLI = False
+
 # Setup logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 # Constants
 API_KEY = os.getenv('COINGECKO_API_KEY', '')
-HEADERS = {'x-cg-demo-api-key': API_KEY}
+HEADERS = {'x-cg-demo-api-key': API_KEY, 'Accept-Encoding': 'br, gzip' if _HAS_BROTLI else 'gzip, deflate'}
 BASE_URL = "https://api.coingecko.com/api/v3"
+CATEGORY_WORKERS = 8
+WRITER_WORKERS = 4
+MAX_RETRIES = 6
+MAX_RETRY_DELAY = 60
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "crypto-narratives")
+CACHE_TTL = 3600
+_LINK_RE = re.compile(r'<([^>]+)>;\s*rel="([^"]+)"')
+_FNAME_TRANS = str.maketrans('', '', r'\/:*?<>|')
+
+# Shared session so every request reuses the same keep-alive connection pool
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=0))
 
 class RateLimiter:
     """Handles rate limiting for API requests."""
     def __init__(self, max_requests, period):
-        self.requests = deque()
-        self.max_requests = max_requests
-        self.period = period
+        self.capacity = max_requests
+        self.tokens = max_requests
+        self.rate = max_requests / period
+        self.max_rate = self.rate
+        self.min_rate = self.rate / 8
+        self.rate_step = self.rate / 10
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
 
     def wait(self):
-        """Ensures compliance with rate limit policies using a monotonic clock."""
-        current_time = time.monotonic()
-        while self.requests and self.requests[0] < current_time - self.period:
-            self.requests.popleft()
-        if len(self.requests) >= self.max_requests:
-            time_to_wait = self.requests[0] + self.period - current_time
-            time.sleep(time_to_wait)
-        self.requests.append(time.monotonic())
+        """Ensures compliance with rate limit policies using a token bucket on a monotonic clock."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.last = time.monotonic()
+                self.tokens = 0
+            else:
+                self.tokens -= 1
 
-def safe_request(url, params=None, rate_limiter=None):
-    """Performs API requests with error handling and rate limiting."""
-    rate_limiter.wait()
-    
+    def on_failure(self):
+        """Halves the request rate after being throttled, down to a floor."""
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            logging.debug(f"Rate limiter slowed to {self.rate:.3f} requests/s")
+
+    def on_success(self):
+        """Additively restores the request rate after a successful request."""
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+def parse_retry_after(headers, default):
+    """Parses the 'Retry-After' header as seconds, returning the default if it is missing or invalid."""
     try:
-        response = requests.get(url, headers=HEADERS, params=params)
-        response.raise_for_status()
-        return response.json(), response.headers
-    except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 429:
-            logging.warning("Rate limit exceeded, retrying...")
-            time.sleep(10)
-            return safe_request(url, params, rate_limiter)
-        logging.error(f"HTTP request failed with status {e.response.status_code}: {e.response.text}")
-        raise
-    except requests.exceptions.RequestException as e:
-        logging.error(f"Request failed: {e}")
-        return None, None
+        return max(0, int(headers.get('Retry-After')))
+    except (TypeError, ValueError):
+        return default
+
+def disk_memoize(ttl):
+    """Caches successful responses on disk for ttl seconds, keyed on the URL and sorted parameters.
+
+    Caching is best-effort: unreadable or unwritable cache files never fail the request.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(url, params=None, rate_limiter=None):
+            key = hashlib.blake2b((url + urlencode(sorted((params or {}).items()))).encode()).hexdigest()
+            path = os.path.join(CACHE_DIR, f"{key}.json")
+            if wrapper.read_cache:
+                try:
+                    with open(path, 'rb') as file:
+                        expiry, body, headers = _json_loads(file.read())
+                    if expiry > time.time():
+                        logging.debug(f"Cache hit for {url} {params}")
+                        return body, CaseInsensitiveDict(headers)
+                except (OSError, ValueError):
+                    pass
+
+            body, headers = func(url, params, rate_limiter)
+            if body is not None:
+                temp_path = f"{path}.{threading.get_ident()}.tmp"
+                try:
+                    os.makedirs(CACHE_DIR, exist_ok=True)
+                    with open(temp_path, 'w') as file:
+                        json.dump([time.time() + ttl, body, dict(headers)], file)
+                    os.replace(temp_path, path)
+                except OSError as e:
+                    logging.warning(f"Failed to write cache entry for {url}: {e}")
+                    try:
+                        os.remove(temp_path)
+                    except OSError:
+                        pass
+            return body, headers
+
+        wrapper.read_cache = True
+        return wrapper
+    return decorator
+
+@disk_memoize(ttl=CACHE_TTL)
+def safe_request(url, params=None, rate_limiter=None):
+    """Performs API requests with error handling, rate limiting and retries on throttling."""
+    for attempt in range(MAX_RETRIES):
+        rate_limiter.wait()
+
+        try:
+            response = SESSION.get(url, params=params, timeout=(5, 30))
+            response.raise_for_status()
+            rate_limiter.on_success()
+            logging.debug(f"Response from {url} encoded as {response.headers.get('Content-Encoding', 'identity')}")
+            return _json_loads(response.content), response.headers
+        except requests.exceptions.HTTPError as e:
+            if e.response.status_code == 429:
+                if attempt == MAX_RETRIES - 1:
+                    break  # No point waiting when there is no attempt left
+                delay = min(MAX_RETRY_DELAY, parse_retry_after(e.response.headers, default=2 ** attempt))
+                logging.warning(f"Rate limit exceeded, retrying in {delay}s...")
+                rate_limiter.on_failure()
+                time.sleep(delay)
+                continue
+            logging.error(f"HTTP request failed with status {e.response.status_code}: {e.response.text}")
+            raise
+        except requests.exceptions.RequestException as e:
+            logging.error(f"Request failed: {e}")
+            return None, None
+        except ValueError as e:
+            logging.error(f"Failed to decode response from {url}: {e}")
+            return None, None
+
+    logging.error(f"Giving up on {url} after {MAX_RETRIES} rate-limited attempts")
+    return None, None
 
 def fetch_categories(rate_limiter, limit):
     """Fetches categories from the API."""
@@ -64,8 +182,8 @@ def fetch_categories(rate_limiter, limit):
         logging.warning("Failed to fetch categories")
         return []
 
-def fetch_coins_by_category(category_id, category_name, rate_limiter, max_coins=1000):
-    """Fetches coin data for a specific category, handling pagination manually."""
+def fetch_category_intersection(category_id, category_name, ticker_coin_ids, rate_limiter, max_coins=1000):
+    """Fetches the coins of a category that have a tracked ticker, scanning at most max_coins coins by market cap."""
     logging.info(f"Fetching coins for category: {category_name}")
     url = f"{BASE_URL}/coins/markets"
     params = {
@@ -76,16 +194,20 @@ def fetch_coins_by_category(category_id, category_name, rate_limiter, max_coins=
         'page': 1
     }
     coins = []
+    scanned = 0
     has_more_data = True
 
-    while has_more_data and len(coins) < max_coins:
+    while has_more_data and scanned < max_coins:
         response, _ = safe_request(url, params=params, rate_limiter=rate_limiter)
         if response:
-            new_coins = [coin['id'] for coin in response]
-            coins.extend(new_coins[:max_coins - len(coins)])  # Ensure we do not exceed max_coins
-            logging.debug(f"Fetched {len(new_coins)} coins for category {category_name} on page {params['page']}")
-            # Check if we have reached the maximum coins or if there are no more coins to fetch
-            if len(coins) >= max_coins or len(new_coins) < params['per_page']:
+            page_len = len(response)
+            remaining = max_coins - scanned
+            # Only keep coins that can be matched to a ticker; never scan beyond max_coins
+            coins.extend(coin['id'] for coin in islice(response, remaining) if coin['id'] in ticker_coin_ids)
+            scanned += min(page_len, remaining)
+            logging.debug(f"Fetched {page_len} coins for category {category_name} on page {params['page']}")
+            # Stop at max_coins, on the last page, or once every tracked coin has been found
+            if scanned >= max_coins or page_len < params['per_page'] or len(coins) == len(ticker_coin_ids):
                 has_more_data = False
             else:
                 params['page'] += 1  # Increment page number for next iteration
@@ -93,7 +215,7 @@ def fetch_coins_by_category(category_id, category_name, rate_limiter, max_coins=
             logging.warning(f"Failed to fetch more coins for category {category_name} on page {params['page']}")
             has_more_data = False
 
-    logging.info(f"Fetched {len(coins)} total coins for category {category_name}")
+    logging.info(f"Matched {len(coins)} of {scanned} coins for category {category_name}")
     return coins
 
 
@@ -119,10 +241,11 @@ def fetch_tickers_for_exchange(exchange_id, exchange_name, target, rate_limiter)
 
 def parse_link_header(link_header):
     """Parses the 'Link' header used for pagination."""
+    if not link_header:
+        return {}
     links = {}
-    link_pattern = re.compile(r'<([^>]+)>;\s*rel="([^"]+)"')
     for link in link_header.split(','):
-        match = link_pattern.search(link)
+        match = _LINK_RE.search(link)
         if match:
             links[match.group(2)] = match.group(1)
     return links
@@ -136,37 +259,36 @@ def update_request_url(next_url):
 
 
 def save_to_tradingview_watchlist(filename, categorized_data, is_index=False):
-    """Saves ticker or index data to a file formatted for TradingView."""
-    # Handle directory creation
-    directory = os.path.dirname(filename)
-
-    # Create the directory if it does not exist
-    if not os.path.exists(directory) and directory != "":
-        os.makedirs(directory)
-        logging.info(f"Directory created: {directory}")
-
+    """Saves ticker or index data to a file formatted for TradingView. The target directory must already exist."""
     logging.info(f"Saving data to file: {filename}")
-    with open(filename, 'w') as file:
-        for category_name, data in categorized_data.items():
-            file.write(f"###{category_name}\n")
-            if is_index:
-                file.write(f"{data}\n\n")
-            else:
-                for ticker in data:
-                    file.write(f"{ticker}\n")
+    # Build the whole file in memory and emit it with a single write
+    parts = []
+    append = parts.append
+    for category_name, data in categorized_data.items():
+        append(f"###{category_name}\n")
+        if is_index:
+            append(f"{data}\n\n")
+        elif data:
+            append("\n".join(data) + "\n")
+    with open(filename, 'w', buffering=1 << 16) as file:
+        file.write("".join(parts))
 
     logging.info(f"Watchlist saved to {filename}")
 
 def create_tradingview_index_string(categorized_tickers):
-    """Creates index strings for TradingView."""
-    return {category: '(' + '*'.join(tickers[:10]) + f")^(1/{len(tickers[:10])})" for category, tickers in categorized_tickers.items()}
+    """Creates index strings for TradingView from up to 10 tickers per category; empty categories get an empty string."""
+    indexes = {}
+    for category, tickers in categorized_tickers.items():
+        top_tickers = tickers[:10]
+        count = len(top_tickers)
+        indexes[category] = f"({'*'.join(top_tickers)})^(1/{count})" if count else ''
+    return indexes
 
-def main(category_limit, coin_limit_per_category, combined_watchlist):
+def main(category_limit, coin_limit_per_category, combined_watchlist, use_cache=True):
     """Main function to orchestrate data fetching and processing."""
+    safe_request.read_cache = use_cache
     rate_limiter = RateLimiter(max_requests=1, period=2)
     categories = fetch_categories(rate_limiter, category_limit)
-    
-    category_coins = OrderedDict((cat['id'], fetch_coins_by_category(cat['id'], cat['name'], rate_limiter, coin_limit_per_category)) for cat in categories)
 
     exchanges = [
         {"api_id": "binance", "name": "Binance"},
@@ -174,40 +296,66 @@ def main(category_limit, coin_limit_per_category, combined_watchlist):
     ]
     target_coin = {'id': 'tether', 'symbol': 'USDT'}
 
+    # Create every output directory once up front rather than per file
     for exchange in exchanges:
-        tickers = fetch_tickers_for_exchange(exchange['api_id'], exchange['name'], target_coin, rate_limiter)
-        ticker_dict = {ticker['coin_id']: f"{exchange['name'].upper()}:{ticker['base']}{ticker['target']}" for ticker in tickers}
-
-        categorized_tickers = OrderedDict((cat['name'], []) for cat in categories)
-        for cat in categories:
-            for coin_id in category_coins[cat['id']]:
-                if coin_id in ticker_dict:
-                    categorized_tickers[cat['name']].append(ticker_dict[coin_id])
-
-        tradingview_indexes = create_tradingview_index_string(categorized_tickers)
-        
-        if combined_watchlist:
-            filename = f"Narratives - {exchange['name']} - Combined.txt"
-            path = f"Watchlists/{exchange['name']}/{filename}"
-            save_to_tradingview_watchlist(path, categorized_tickers)
-        else:
-            for cat in categorized_tickers:
-                filename = f"Narratives - {exchange['name']} - {cat}.txt"
-                safe_filename = "".join(i for i in filename if i not in "\/:*?<>|")
-                path = f"Watchlists/{exchange['name']}/{safe_filename}"
-                save_to_tradingview_watchlist(path, {cat: categorized_tickers[cat]})
-        
-        filename = f"Watchlists/Narratives - {exchange['name']} - Indicies.txt"
-        save_to_tradingview_watchlist(filename, tradingview_indexes, is_index=True)
+        os.makedirs(f"Watchlists/{exchange['name']}", exist_ok=True)
+
+    # Fetch every exchange's tickers concurrently, sharing the same rate limiter
+    with ThreadPoolExecutor(max_workers=len(exchanges)) as pool:
+        exchange_tickers = list(pool.map(lambda exchange: fetch_tickers_for_exchange(exchange['api_id'], exchange['name'], target_coin, rate_limiter), exchanges))
+
+    ticker_dicts = [
+        {ticker['coin_id']: f"{exchange['name'].upper()}:{ticker['base']}{ticker['target']}" for ticker in tickers}
+        for exchange, tickers in zip(exchanges, exchange_tickers)
+    ]
+    ticker_coin_ids = set().union(*ticker_dicts)
+
+    # Fetch categories concurrently; the shared rate limiter keeps the request rate in check
+    with ThreadPoolExecutor(max_workers=CATEGORY_WORKERS) as pool:
+        results = pool.map(lambda cat: fetch_category_intersection(cat['id'], cat['name'], ticker_coin_ids, rate_limiter, coin_limit_per_category), categories)
+        category_coins = {cat['id']: coins for cat, coins in zip(categories, results)}
+
+    # Write files in the background so disk I/O overlaps with processing the next exchange
+    writes = []
+    with ThreadPoolExecutor(max_workers=WRITER_WORKERS) as writer_pool:
+        for exchange, ticker_dict in zip(exchanges, ticker_dicts):
+            # Single lookup per coin, keeping each category's market cap order
+            get_ticker = ticker_dict.get
+            categorized_tickers = {
+                cat['name']: [ticker for ticker in map(get_ticker, category_coins[cat['id']]) if ticker is not None]
+                for cat in categories
+            }
+
+            tradingview_indexes = create_tradingview_index_string(categorized_tickers)
+
+            prefix = f"Narratives - {exchange['name']} - "
+            if combined_watchlist:
+                filename = f"{prefix}Combined.txt"
+                path = f"Watchlists/{exchange['name']}/{filename}"
+                writes.append(writer_pool.submit(save_to_tradingview_watchlist, path, categorized_tickers))
+            else:
+                for cat in categorized_tickers:
+                    filename = f"{prefix}{cat}.txt"
+                    safe_filename = filename.translate(_FNAME_TRANS)
+                    path = f"Watchlists/{exchange['name']}/{safe_filename}"
+                    writes.append(writer_pool.submit(save_to_tradingview_watchlist, path, {cat: categorized_tickers[cat]}))
+
+            filename = f"Watchlists/{prefix}Indicies.txt"
+            writes.append(writer_pool.submit(save_to_tradingview_watchlist, filename, tradingview_indexes, is_index=True))
+
+    # Surface any error raised while writing
+    for write in writes:
+        write.result()
 
     logging.info("Data collection complete")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Fetch and process crypto data for TradingView.")
     parser.add_argument("-l", "--category_limit", type=int, default=500, help="Limit the number of categories to process.")
-    parser.add_argument("-c", "--combined", type=bool, default=False, help="Combine all watchlists into one.")
+    parser.add_argument("-c", "--combined", action=argparse.BooleanOptionalAction, default=False, help="Combine all watchlists into one.")
     parser.add_argument("-m", "--max_coins", type=int, default=1000, help="Maximum number of coins to fetch per category.")
+    parser.add_argument("--no-cache", action="store_true", help="Ignore cached CoinGecko responses and fetch fresh data, refreshing the cache.")
     args = parser.parse_args()
-    main(args.category_limit, args.max_coins, args.combined)
+    main(args.category_limit, args.max_coins, args.combined, use_cache=not args.no_cache)
 
 